@@ -1,7 +1,10 @@
+import collections
 import copy
 import datetime
 import gevent
+import os
 import random
+import signal
 
 from tenyksservice import TenyksService, run_service, FilterChain
 from tenyksservice.config import settings
@@ -44,6 +47,13 @@ HELP_TEXT = '''Tenyks Cards Against Humanity
     Canceling the game:
         You can tell tenyks to cancel the current game only if you are the game host:
             "!cah cancel"
+
+    Profiling (admins only, see CAH_ADMINS in settings):
+        To sample where the service spends its time for a while:
+            "!cah profile start" or "!cah profile start 60" (at most 600 seconds)
+
+        To stop early and write the collapsed stack file:
+            "!cah profile stop"
 '''
 
 MAX_GAME_DURATION = 36000 # in seconds
@@ -60,6 +70,12 @@ GAME_PHASE_ANSWERS = 2
 GAME_PHASE_SELECTION = 3
 GAME_PHASE_CONCLUSION = 4
 
+PROFILE_SAMPLE_INTERVAL = 0.005 # in seconds of cpu time
+PROFILE_DEFAULT_DURATION = 30 # in seconds
+PROFILE_MAX_DURATION = 600 # in seconds
+PROFILE_SUPPORTED = all(hasattr(signal, name) for name in
+                        ('SIGPROF', 'SIGUSR2', 'ITIMER_PROF', 'setitimer'))
+
 
 class CardsAgainstHumanityService(TenyksService):
     irc_message_filters = {
@@ -102,6 +118,10 @@ class CardsAgainstHumanityService(TenyksService):
         'kick_player': FilterChain(
             [r'^!cah kick (?P<_nick>(?<=[^a-z_\-\[\]\\^{}|`])[a-z_\-\[\]\\^{}|`][a-z0-9_\-\[\]\\^{}|`]*)$'],
             direct_only=False),
+
+        'profile': FilterChain(
+            [r'^!cah profile (?P<action>start|stop)( (?P<duration>[0-9]+))?$'],
+            direct_only=False),
     }
 
     help_text = HELP_TEXT
@@ -110,6 +130,9 @@ class CardsAgainstHumanityService(TenyksService):
         # keys are IRC channel names and values are game objects
         self.games = {}
         super(CardsAgainstHumanityService, self).__init__(*args, **kwargs)
+        self.profiler = SamplingProfiler(
+            getattr(settings, 'CAH_PROFILE_DIR', '.'), self.logger)
+        self.profiler.install_signal_handler()
 
     def handle_new_game(self, data, match):
         channel = data['target']
@@ -355,6 +378,41 @@ class CardsAgainstHumanityService(TenyksService):
         player = game.set_and_return_next_czar()
         self.send('{}, you\'re up as card czar. Say "!cah play card" in the channel to throw down your question card'.format(player.name), data)
 
+    def handle_profile(self, data, match):
+        nick = data['nick']
+        if nick not in getattr(settings, 'CAH_ADMINS', []):
+            self.send('{}: Only admins can use the profiler.'.format(nick), data)
+            return
+
+        if not PROFILE_SUPPORTED:
+            self.send('{}: Profiling isn\'t supported on this platform.'.format(nick), data)
+            return
+
+        if match.groupdict()['action'] == 'start':
+            if self.profiler.running:
+                self.send('{}: The profiler is already running.'.format(nick), data)
+                return
+            duration = int(match.groupdict()['duration'] or PROFILE_DEFAULT_DURATION)
+            if duration < 1:
+                self.send('{}: The duration has to be at least 1 second.'.format(nick), data)
+                return
+            if duration > PROFILE_MAX_DURATION:
+                duration = PROFILE_MAX_DURATION
+                self.send('{}: The longest I\'ll profile for is {} seconds, so I\'m using that.'.format(nick, duration), data)
+            self.profiler.start(duration, on_expire=lambda path: self._report_profile(nick, path, copy.copy(data)))
+            self.send('{}: Profiling for {} seconds. Say "!cah profile stop" to stop early.'.format(nick, duration), data)
+        else:
+            if not self.profiler.running:
+                self.send('{}: The profiler isn\'t running.'.format(nick), data)
+                return
+            self._report_profile(nick, self.profiler.stop(), data)
+
+    def _report_profile(self, nick, path, data):
+        if path:
+            self.send('{}: Profile written to {}'.format(nick, path), data)
+        else:
+            self.send('{}: I couldn\'t write the profile. Check the logs.'.format(nick), data)
+
     def _pm_hands(self, data, game):
         for player in game.players:
             gevent.spawn(self._pm_hand_to_player, player, copy.copy(data), game)
@@ -527,6 +585,100 @@ class Player(object):
         self.hand = []
 
 
+class SamplingProfiler(object):
+    """Statistical profiler driven by SIGPROF.
+
+    Every PROFILE_SAMPLE_INTERVAL seconds of cpu time the interrupted frame's
+    stack is recorded. Greenlets all share the one OS thread, so whichever
+    greenlet is running gets sampled. Nothing is installed while stopped.
+    Results are written in the collapsed stack format flamegraph.pl reads.
+    """
+
+    def __init__(self, output_dir, logger):
+        self.output_dir = output_dir
+        self.logger = logger
+        self.samples = collections.Counter()
+        self.running = False
+        self.started = None
+        self.timer = None
+        self.previous_handler = None
+
+    def install_signal_handler(self):
+        if not PROFILE_SUPPORTED:
+            return
+        # runs the toggle in its own greenlet rather than whichever one the
+        # signal happens to interrupt
+        register = getattr(gevent, 'signal_handler', None) or gevent.signal
+        register(signal.SIGUSR2, self._toggle)
+
+    def start(self, duration=PROFILE_DEFAULT_DURATION, on_expire=None):
+        if self.running:
+            return False
+        self.samples.clear()
+        self.running = True
+        self.started = datetime.datetime.now()
+        self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF,
+                         PROFILE_SAMPLE_INTERVAL, PROFILE_SAMPLE_INTERVAL)
+        self.timer = gevent.spawn_later(duration, self._expire, on_expire)
+        self.logger.info('Profiler started for {} seconds'.format(duration))
+        return True
+
+    def stop(self):
+        """Stops sampling and returns the path of the written profile, or
+        None if it couldn't be written.
+        """
+        if not self.running:
+            return None
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        # a handler installed outside of Python comes back as None
+        if self.previous_handler is None:
+            self.previous_handler = signal.SIG_IGN
+        signal.signal(signal.SIGPROF, self.previous_handler)
+        self.previous_handler = None
+        self.running = False
+        if self.timer is not None and self.timer is not gevent.getcurrent():
+            self.timer.kill(block=False)
+        self.timer = None
+
+        try:
+            path = self._write()
+        except (IOError, OSError):
+            self.logger.exception('Profiler could not write its output')
+            return None
+        self.logger.info('Profile written to {}'.format(path))
+        return path
+
+    def _expire(self, on_expire):
+        path = self.stop()
+        if on_expire is not None:
+            on_expire(path)
+
+    def _toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}:{}'.format(
+                os.path.basename(code.co_filename), code.co_name,
+                code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def _write(self):
+        path = os.path.join(self.output_dir, 'cah-profile-{}-{}.collapsed'.format(
+            os.getpid(), self.started.strftime('%Y%m%d-%H%M%S-%f')))
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+
 def main():
     run_service(CardsAgainstHumanityService)
 